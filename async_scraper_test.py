@@ -0,0 +1,138 @@
+import pytest
+
+# aiohttp is an optional dependency
+pytest.importorskip("aiohttp")
+
+from itunes_app_scraper.async_scraper import AsyncAppStoreScraper
+from itunes_app_scraper.scraper import DEFAULT_HEADERS
+from itunes_app_scraper.util import AppStoreException
+
+from urllib.parse import urlsplit
+import asyncio
+
+from scraper_test import APPS, lookup_body, lookup_ids, rating_page
+
+
+class FakeAsyncResponse:
+    """
+    Stand-in for aiohttp.ClientResponse
+    """
+    def __init__(self, content=b"", status=200, headers=None):
+        self.content = content
+        self.status = status
+        self.headers = headers or {}
+
+    async def read(self):
+        return self.content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    """
+    Stand-in for aiohttp.ClientSession, answering lookup and rating requests
+    """
+    closed = False
+
+    def __init__(self, ratings=None):
+        self.ratings = ratings or {}
+        self.requested = []
+
+    def get(self, url, headers=None):
+        self.requested.append(url)
+        parts = urlsplit(url)
+        if parts.path == "/lookup":
+            return FakeAsyncResponse(lookup_body(url, APPS))
+
+        country = parts.path.split("/")[1]
+        return FakeAsyncResponse(rating_page(*self.ratings.get(country, (0, 0, 0, 0, 0))))
+
+    async def close(self):
+        self.closed = True
+
+
+def mock_session(scraper, ratings=None):
+    session = FakeSession(ratings)
+    scraper._session = session
+    scraper._semaphore = asyncio.Semaphore(scraper.concurrency)
+    return session
+
+
+def test_session_sends_user_agent():
+    async def run():
+        async with AsyncAppStoreScraper() as scraper:
+            return scraper._session.headers["User-Agent"]
+
+    assert asyncio.run(run()) == DEFAULT_HEADERS["User-Agent"]
+
+def test_scraper_options_are_passed_on():
+    scraper = AsyncAppStoreScraper(concurrency=5, cache_ttl=60, rate_limit=2, max_workers=4)
+    assert scraper.concurrency == 5
+    assert scraper._details_cache.ttl == 60
+    assert scraper._get_rate_limiter("https://itunes.apple.com/lookup").rate == 2
+    assert scraper.max_workers == 4
+
+def test_multiple_details_are_looked_up_in_batches():
+    async def run():
+        scraper = AsyncAppStoreScraper()
+        session = mock_session(scraper)
+        scraper._log_error = lambda country, message: None
+        apps = [app async for app in scraper.get_multiple_app_details([2, "com.example.one", 872, 2])]
+        return apps, session.requested
+
+    apps, requested = asyncio.run(run())
+    assert [app["trackName"] for app in apps] == ["Two", "One", "Two"]
+    assert sorted(lookup_ids(url) for url in requested) == ["2,872", "com.example.one"]
+
+def test_multiple_details_keep_results_of_successful_lookup():
+    async def run():
+        scraper = AsyncAppStoreScraper()
+        mock_session(scraper)
+        scraper._backoff_delay = lambda *args, **kwargs: 0
+        store_fetch = scraper._fetch
+
+        async def fetch(url, **kwargs):
+            if "bundleId=" in url:
+                raise AppStoreException("Could not retrieve %s" % url)
+            return await store_fetch(url, **kwargs)
+
+        scraper._fetch = fetch
+        logged = []
+        scraper._log_error = lambda country, message: logged.append(message)
+        apps = [app async for app in scraper.get_multiple_app_details([1, "com.example.two"])]
+        return apps, logged
+
+    apps, logged = asyncio.run(run())
+    assert [app["trackId"] for app in apps] == [1]
+    assert logged == ["Could not parse app store response for ID com.example.two"]
+
+def test_details_and_ratings_are_cached():
+    async def run():
+        scraper = AsyncAppStoreScraper()
+        session = mock_session(scraper, ratings={"us": (5, 4, 3, 2, 1)})
+        first = await scraper.get_app_details(1)
+        requests_made = len(session.requested)
+        second = await scraper.get_app_details(1)
+        cached_requests = len(session.requested) - requests_made
+
+        session.ratings = {"us": (50, 40, 30, 20, 10)}
+        forced = await scraper.get_app_details(1, force=True)
+        return first, second, cached_requests, forced
+
+    first, second, cached_requests, forced = asyncio.run(run())
+    assert first["histogram"] == [1, 2, 3, 4, 5]
+    assert second == first
+    assert cached_requests == 0
+    assert forced["histogram"] == [10, 20, 30, 40, 50]
+
+def test_ratings_are_summed_over_countries():
+    async def run():
+        scraper = AsyncAppStoreScraper()
+        mock_session(scraper, ratings={"de": (5, 4, 3, 2, 1), "nl": (1, 1, 1, 1, 1)})
+        return await scraper.get_app_ratings(1, countries=["de", "nl"])
+
+    assert asyncio.run(run()) == {1: 2, 2: 3, 3: 4, 4: 5, 5: 6}
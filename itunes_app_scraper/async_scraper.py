@@ -0,0 +1,320 @@
+"""
+Asynchronous iTunes App Store Scraper
+"""
+import asyncio
+import aiohttp
+import orjson
+
+from itunes_app_scraper.scraper import AppStoreScraper, DEFAULT_HEADERS
+from itunes_app_scraper.util import AppStoreException, COUNTRIES
+
+
+class AsyncAppStoreScraper(AppStoreScraper):
+	"""
+	Asynchronous iTunes App Store scraper
+
+	Variant of `AppStoreScraper` for bulk scrapes, which issues its requests
+	concurrently over a single aiohttp session instead of one after the
+	other. `get_app_details`, `get_app_ratings`, `get_multiple_app_details`
+	and `get_ratings_matrix` are coroutines here; all other methods are
+	inherited as-is and remain synchronous. The result caches and per-host
+	rate limiting work as in `AppStoreScraper`.
+
+	Use it as an async context manager so the session gets closed:
+
+		async with AsyncAppStoreScraper() as scraper:
+			ratings = await scraper.get_app_ratings(app_id)
+	"""
+
+	def __init__(self, concurrency=20, limit_per_host=64, **kwargs):
+		"""
+		:param int concurrency:  Maximum amount of requests in flight at once
+		:param int limit_per_host:  Maximum amount of open connections per host
+		:param kwargs:  Passed on to `AppStoreScraper`, e.g. `cache_ttl` and
+		                `rate_limit`
+		"""
+		super().__init__(**kwargs)
+		self.concurrency = concurrency
+		self.limit_per_host = limit_per_host
+		self._session = None
+		self._semaphore = None
+
+	async def __aenter__(self):
+		self._get_session()
+		return self
+
+	async def __aexit__(self, exc_type, exc, traceback):
+		await self.close()
+
+	async def close(self):
+		"""
+		Close the HTTP sessions and any open error log files
+		"""
+		if self._session is not None:
+			await self._session.close()
+			self._session = None
+
+		super().close()
+
+	async def get_app_details(self, app_id, country="us", lang="", add_ratings=True, flatten=True, force=False, use_cache=True):
+		"""
+		Get app details for given app ID
+
+		See `AppStoreScraper.get_app_details`.
+
+		:return dict:  App details, as returned by the app store
+		"""
+		cache_key = (self._get_lookup_key(app_id), country, add_ratings, flatten)
+		if use_cache and not force:
+			app = self._get_cached(self._details_cache, cache_key)
+			if app is not None:
+				return app
+
+		url = self._get_lookup_url(app_id, country, force)
+
+		try:
+			result = await self._fetch(url, as_json=True)
+		except AppStoreException:
+			raise AppStoreException("Could not parse app store response for ID %s" % app_id)
+
+		try:
+			app = result["results"][0]
+		except (KeyError, IndexError):
+			raise AppStoreException("No app found with ID %s" % app_id)
+
+		if flatten:
+			app = self._flatten_app(app)
+
+		if add_ratings:
+			app['histogram'] = await self._get_histogram(app_id, country, use_cache=use_cache and not force)
+
+		self._set_cached_app(cache_key, app)
+		return app
+
+	async def get_multiple_app_details(self, app_ids, country="us", lang="", add_ratings=False, force=False, use_cache=True):
+		"""
+		Get app details for a list of app IDs
+
+		Apps are looked up in batches of `LOOKUP_BATCH_SIZE` IDs per request,
+		and all batches are requested concurrently. Within a batch, details
+		are yielded in the order of `app_ids`, but batches are yielded in the
+		order in which they complete.
+
+		See `AppStoreScraper.get_multiple_app_details`.
+
+		:return async generator:  App details
+		"""
+		app_ids = list(app_ids)
+		batches = [[(app_id, self._get_lookup_key(app_id)) for app_id in app_ids[offset:offset + self.LOOKUP_BATCH_SIZE]] for offset in range(0, len(app_ids), self.LOOKUP_BATCH_SIZE)]
+		tasks = [asyncio.ensure_future(self._get_batch_details(batch, country, add_ratings, force, use_cache)) for batch in batches]
+
+		try:
+			for future in asyncio.as_completed(tasks):
+				for app in await future:
+					yield app
+		finally:
+			# if the caller stops iterating early, don't leave requests dangling
+			for task in tasks:
+				task.cancel()
+
+	async def get_app_ratings(self, app_id, countries=None, use_cache=True):
+		"""
+		Get app ratings for given app ID
+
+		All countries are requested concurrently. See
+		`AppStoreScraper.get_app_ratings`.
+
+		:return dict:  App ratings, as scraped from the app store.
+		"""
+		if countries is None:
+			countries = COUNTRIES
+		elif isinstance(countries, str): # only a string provided
+			countries = [countries]
+		else:
+			countries = list(countries)
+
+		cache_key = (str(app_id), tuple(countries))
+		if use_cache:
+			cached = self._get_cached(self._ratings_cache, cache_key)
+			if cached is not None:
+				return cached
+
+		results = await asyncio.gather(*[self._fetch_country_rating(app_id, country) for country in countries])
+
+		totals = [0] * 5
+		for ratings in results:
+			if ratings is not None:
+				totals = [total + count for total, count in zip(totals, ratings)]
+
+		dataset = self._ratings_to_dict(totals)
+		self._set_cached(self._ratings_cache, cache_key, dataset)
+		return dataset
+
+	async def get_ratings_matrix(self, app_ids, countries=None):
+		"""
+		Get ratings histograms for many apps at once
+
+		All combinations of app and country are requested concurrently. See
+		`AppStoreScraper.get_ratings_matrix`.
+
+		:return numpy.ndarray:  Array of shape (len(app_ids), 5), with per
+		                        app the amount of ratings for one through five
+		                        stars
+		"""
+		if countries is None:
+			countries = COUNTRIES
+		elif isinstance(countries, str): # only a string provided
+			countries = [countries]
+		else:
+			countries = list(countries)
+
+		app_ids = list(app_ids)
+		matrix = self._new_ratings_matrix(len(app_ids), len(countries))
+		cells = [(i, j) for i in range(len(app_ids)) for j in range(len(countries))]
+
+		results = await asyncio.gather(*[self._fetch_country_rating(app_ids[i], countries[j]) for i, j in cells], return_exceptions=True)
+
+		for (i, j), ratings in zip(cells, results):
+			if isinstance(ratings, AppStoreException):
+				self._log_error(countries[j], 'Unable to collect ratings for %s' % str(app_ids[i]))
+			elif isinstance(ratings, BaseException):
+				raise ratings
+			elif ratings is not None:
+				matrix[i, j] = ratings[::-1]
+
+		return matrix.sum(axis=1)
+
+	async def _get_batch_details(self, batch, country, add_ratings, force, use_cache):
+		"""
+		Get app details for one batch of app IDs
+
+		:param list batch:  (app ID, lookup key) tuples
+		:param str country:  Two-letter country code
+		:param bool add_ratings:  Add a ratings histogram to each app
+		:param bool force:  By-pass server side and local caching
+		:param bool use_cache:  Use the local cache where available
+
+		:return list:  App details in the order of `batch`
+		"""
+		cached, uncached = self._split_cached_batch(batch, country, add_ratings, use_cache and not force)
+
+		found = {}
+		if uncached:
+			urls = self._get_batch_lookup_urls(list(uncached.values()), country, force)
+			results = await asyncio.gather(*[self._fetch(url, as_json=True) for url, url_app_ids in urls], return_exceptions=True)
+
+			# if one request fails, keep the results of the other
+			failed = []
+			for (url, url_app_ids), result in zip(urls, results):
+				if isinstance(result, AppStoreException):
+					failed.extend(url_app_ids)
+				elif isinstance(result, BaseException):
+					raise result
+				else:
+					self._index_lookup_result(result, found)
+
+			uncached = self._drop_failed_lookups(uncached, failed, country)
+
+		new_apps = self._collect_found_apps(uncached, found, country)
+
+		if add_ratings and new_apps:
+			histograms = await asyncio.gather(*[self._get_histogram(app["trackId"], country, use_cache=use_cache and not force) for app in new_apps.values()])
+			for app, histogram in zip(new_apps.values(), histograms):
+				app['histogram'] = histogram
+
+		return self._finish_batch(batch, cached, new_apps, country, add_ratings)
+
+	async def _get_histogram(self, app_id, country="us", use_cache=True):
+		"""
+		Get the ratings histogram for an app in a single store
+
+		See `AppStoreScraper._get_histogram`.
+
+		:return list|None:  Amount of ratings for one through five stars, or
+		                    None if they could not be collected
+		"""
+		try:
+			ratings = await self.get_app_ratings(app_id, countries=[country], use_cache=use_cache)
+			return [value for key, value in ratings.items()]
+		except AppStoreException:
+			self._log_error(country, 'Unable to collect ratings for %s' % str(app_id))
+			return None
+
+	async def _fetch_country_rating(self, app_id, country):
+		"""
+		Get the ratings histogram for an app in a single country's store
+
+		:param app_id:  App ID to retrieve ratings for
+		:param str country:  Two-letter country code
+
+		:return tuple|None:  Ratings from five stars down to one, or None if
+		                     they could not be parsed
+		"""
+		url = "https://itunes.apple.com/%s/customer-reviews/id%s?displayable-kind=11" % (country, app_id)
+		headers = self._get_rating_headers(country)
+
+		try:
+			result = await self._fetch(url, headers=headers)
+		except AppStoreException:
+			raise AppStoreException("Could not parse app store rating response for ID %s" % app_id)
+
+		return self._parse_rating(result)
+
+	async def _fetch(self, url, headers=None, as_json=False, max_retries=5, base=0.5, cap=30):
+		"""
+		Request a URL, with at most `concurrency` requests in flight
+
+		Requests are paced by the same per-host rate limiters as the
+		synchronous scraper, and failed requests are retried with the same
+		backoff as `AppStoreScraper._request_with_retry`. The semaphore is
+		released while waiting, so other requests can proceed.
+
+		:param str url:  URL to request
+		:param dict headers:  Request headers
+		:param bool as_json:  Parse the response as JSON rather than returning
+		                      the raw body
+		:param int max_retries:  Amount of attempts before giving up
+		:param float base:  Base delay in seconds
+		:param float cap:  Maximum delay in seconds
+
+		:return:  Response body as bytes, or parsed JSON if `as_json` is True
+		"""
+		session = self._get_session()
+		rate_limiter = self._get_rate_limiter(url)
+
+		for attempt in range(max_retries):
+			retry_after = None
+			await rate_limiter.acquire_async()
+
+			async with self._semaphore:
+				try:
+					async with session.get(url, headers=headers) as response:
+						retry_after = self._hold_off_host(rate_limiter, response.headers, cap)
+
+						if response.status not in (429, 503):
+							content = await response.read()
+							return orjson.loads(content) if as_json else content
+				except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError):
+					pass
+
+			if attempt < max_retries - 1 and retry_after is None:
+				# if the store said when to retry, the rate limiter waits
+				await asyncio.sleep(self._backoff_delay(attempt, base, cap))
+
+		raise AppStoreException("Could not retrieve %s after %i attempts" % (url, max_retries))
+
+	def _get_session(self):
+		"""
+		Get the HTTP session, creating it if needed
+
+		The session is created lazily because aiohttp wants it to be created
+		from within a running event loop.
+
+		:return aiohttp.ClientSession:  Session
+		"""
+		if self._session is None or self._session.closed:
+			connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host)
+			self._session = aiohttp.ClientSession(connector=connector, headers=DEFAULT_HEADERS)
+			self._semaphore = asyncio.Semaphore(self.concurrency)
+
+		return self._session
@@ -2,19 +2,60 @@
 iTunes App Store Scraper
 """
 import requests
-import json
+import atexit
+import copy
+import itertools
+import random
+import orjson
 import time
 import re
 import os
-from datetime import datetime
+import threading
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from html import unescape
 from typing import List
-from lxml import html
+from requests.adapters import HTTPAdapter
 
-from urllib.parse import quote_plus
-from itunes_app_scraper.util import AppStoreException, AppStoreCollections, AppStoreCategories, AppStoreMarkets, COUNTRIES
+from urllib.parse import quote_plus, urlsplit
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+from itunes_app_scraper.util import AppStoreException, AppStoreCollections, AppStoreCategories, RateLimiter, COUNTRIES, COUNTRY_STOREFRONT_HEADERS, _MARKET_BY_CC
 
 class Regex:
-	STARS = re.compile(r"<span class=\"total\">[\s\S]*?</span>")
+	STARS = re.compile(rb"<span class=\"total\">(\d+)</span>")
+	APP_ID_HREF = re.compile(rb"href=\"[^\"]*/app/[^\"]*?/id(\d+)")
+	SUGGESTION = re.compile(rb"<string>([^<]+)</string>")
+	SIMILAR_APPS = re.compile(rb"customersAlsoBoughtApps\":\s*(\[[^\]]+\])")
+
+
+# error log files are kept open per path, shared by all scrapers, until exit
+_log_handles = {}
+_log_lock = threading.Lock()
+
+
+def _close_logs():
+	"""
+	Close any error log files opened by `AppStoreScraper._log_error`
+	"""
+	with _log_lock:
+		for fh in _log_handles.values():
+			fh.close()
+		_log_handles.clear()
+
+
+atexit.register(_close_logs)
+
+
+# sent with every request, by both the synchronous and asynchronous scraper
+DEFAULT_HEADERS = {
+	'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Safari/537.36'
+}
 
 
 class AppStoreScraper:
@@ -27,6 +68,53 @@ class AppStoreScraper:
 	can be found at https://github.com/facundoolano/app-store-scraper.
 	"""
 
+	# maximum amount of IDs per request to the lookup API
+	LOOKUP_BATCH_SIZE = 100
+
+	def __init__(self, max_workers=16, cache_ttl=3600, rate_limit=10):
+		"""
+		Set up a shared HTTP session and result caches
+
+		Most requests go to the same few Apple hosts, so connections are kept
+		alive and pooled rather than set up anew for every request. App
+		details and ratings are kept in memory for `cache_ttl` seconds, so
+		repeated lookups of the same app do not hit the store again. Requests
+		are paced per host, backing off further when the store asks for it.
+
+		:param int max_workers:  Maximum amount of concurrent requests when
+		                         fetching e.g. ratings for many countries
+		:param int cache_ttl:  Seconds to cache app details and ratings for
+		:param int rate_limit:  Maximum amount of requests per second per host
+		"""
+		self.max_workers = max_workers
+		self.rate_limit = rate_limit
+		self._rate_limiters = {}
+		self._rate_limiters_lock = threading.Lock()
+		self._cache_buster_seq = itertools.count()
+
+		# request headers are built once and shared between requests; they
+		# must not be modified
+		self._rating_headers = {cc: {'X-Apple-Store-Front': storefront} for cc, storefront in COUNTRY_STOREFRONT_HEADERS.items()}
+		self._search_headers = {}
+		self._details_cache = TTLCache(maxsize=10000, ttl=cache_ttl)
+		self._ratings_cache = TTLCache(maxsize=10000, ttl=cache_ttl)
+		self._cache_lock = threading.Lock()
+
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0)
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+		self.session.headers.update(DEFAULT_HEADERS)
+
+	def close(self):
+		"""
+		Close the HTTP session and any open error log files
+
+		Log files are reopened when another error is logged.
+		"""
+		self.session.close()
+		_close_logs()
+
 	def get_app_ids_for_query(self, term, num=50, page=1, country="us", lang="nl", timeout=2, headers={
                                                                         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Safari/537.36'
                                                                     }):
@@ -50,18 +138,15 @@ class AppStoreScraper:
 
 		amount = int(num) * int(page)
 
-		country = self.get_store_id_for_country(country)
-		headers = {
-			"X-Apple-Store-Front": "%s,24 t:native" % country,
-			"Accept-Language": lang
-		}
+		headers = self._search_headers.get((country, lang))
+		if headers is None:
+			headers = {
+				"X-Apple-Store-Front": "%s,24 t:native" % self.get_store_id_for_country(country),
+				"Accept-Language": lang
+			}
+			self._search_headers[(country, lang)] = headers
 
-		try:
-			result = requests.get(url, headers=headers, timeout=timeout).json()
-		except ConnectionError as ce:
-			raise AppStoreException("Cannot connect to store: {0}".format(str(ce)))
-		except json.JSONDecodeError:
-			raise AppStoreException("Could not parse app store response")
+		result = self._request_with_retry(url, headers=headers, as_json=True, timeout=timeout)
 
 		return [app["id"] for app in result["bubbles"][0]["results"][:amount]]
 
@@ -89,10 +174,7 @@ class AppStoreScraper:
 		params = (collection, category, num, country)
 		url = "http://ax.itunes.apple.com/WebObjects/MZStoreServices.woa/ws/RSS/%s/%s/limit=%s/json?s=%s" % params
 
-		try:
-			result = requests.get(url).json()
-		except json.JSONDecodeError:
-			raise AppStoreException("Could not parse app store response")
+		result = self._request_with_retry(url, as_json=True)
 
 		return [entry["id"]["attributes"]["im:id"] for entry in result["feed"]["entry"]]
 
@@ -109,10 +191,7 @@ class AppStoreScraper:
 		"""
 		url = "https://itunes.apple.com/lookup?id=%s&country=%s&entity=software" % (developer_id, country)
 
-		try:
-			result = requests.get(url).json()
-		except json.JSONDecodeError:
-			raise AppStoreException("Could not parse app store response")
+		result = self._request_with_retry(url, as_json=True)
 
 		if "results" in result:
 			return [app["trackId"] for app in result["results"] if app["wrapperType"] == "software"]
@@ -126,7 +205,8 @@ class AppStoreScraper:
 
 		This one is a bit special because the response is not JSON, but HTML.
 		We extract a JSON blob from the HTML which contains the relevant App
-		IDs.
+		IDs. The page is large, so it is read in chunks and the download is
+		abandoned as soon as the blob has been found.
 
 		:param app_id:  App ID to find similar apps for
 		:param str country:  Two-letter country code for the store to search in.
@@ -143,22 +223,20 @@ class AppStoreScraper:
 			"Accept-Language": lang
 		}
 
-		result = requests.get(url, headers=headers).text
-		if "customersAlsoBoughtApps" not in result:
-			return []
+		result = self._read_until(url, b"]", start_marker=b"customersAlsoBoughtApps", headers=headers)
 
-		blob = re.search(r"customersAlsoBoughtApps\":\s*(\[[^\]]+\])", result)
+		blob = Regex.SIMILAR_APPS.search(result)
 		if not blob:
 			return []
 
 		try:
-			ids = json.loads(blob[1])
-		except (json.JSONDecodeError, IndexError):
+			ids = orjson.loads(blob[1])
+		except (orjson.JSONDecodeError, IndexError):
 			return []
 
 		return ids
 
-	def get_app_details(self, app_id, country="us", lang="", add_ratings=True, flatten=True, sleep=None, force=False):
+	def get_app_details(self, app_id, country="us", lang="", add_ratings=True, flatten=True, sleep=None, force=False, use_cache=True):
 		"""
 		Get app details for given app ID
 
@@ -172,41 +250,32 @@ class AppStoreScraper:
 		                     so if this parameter is True (its default) the
 		                     response is flattened and any non-scalar values
 		                     are removed from the response.
-		:param int sleep: Seconds to sleep before request to prevent being
-						  temporary blocked if there are many requests in a
-						  short time. Defaults to None.
+		:param int sleep: Seconds to sleep before request, on top of the
+						  per-host rate limiting. Defaults to None.
 		:param bool force:  by-passes the server side caching by adding a timestamp
-		                    to the request (default is False)
+		                    to the request (default is False). Also by-passes
+		                    the local cache.
+		:param bool use_cache:  Return recently retrieved details for the same
+		                        app from the local cache (default is True)
 
 		:return dict:  App details, as returned by the app store. The result is
 		               not processed any further, unless `flatten` is True
 		"""
-		try:
-			app_id = int(app_id)
-			id_field = "id"
-		except ValueError:
-			id_field = "bundleId"
+		cache_key = (self._get_lookup_key(app_id), country, add_ratings, flatten)
+		if use_cache and not force:
+			app = self._get_cached(self._details_cache, cache_key)
+			if app is not None:
+				return app
 
-		if force:
-			# this will by-pass the serverside caching
-			import secrets
-			timestamp = secrets.token_urlsafe(8)
-			url = "https://itunes.apple.com/lookup?%s=%s&country=%s&entity=software&timestamp=%s" % (id_field, app_id, country, timestamp)
-		else:
-			url = "https://itunes.apple.com/lookup?%s=%s&country=%s&entity=software" % (id_field, app_id, country)
+		url = self._get_lookup_url(app_id, country, force)
+
+		if sleep is not None:
+			time.sleep(sleep)
 
 		try:
-			if sleep is not None:
-				time.sleep(sleep)
-			result = requests.get(url).json()
-		except Exception:
-			try:
-				# handle the retry here.
-				# Take an extra sleep as back off and then retry the URL once.
-				time.sleep(2)
-				result = requests.get(url).json()
-			except Exception:
-				raise AppStoreException("Could not parse app store response for ID %s" % app_id)
+			result = self._request_with_retry(url, as_json=True)
+		except AppStoreException:
+			raise AppStoreException("Could not parse app store response for ID %s" % app_id)
 
 		try:
 			app = result["results"][0]
@@ -214,24 +283,11 @@ class AppStoreScraper:
 			raise AppStoreException("No app found with ID %s" % app_id)
 
 
-		# 'flatten' app response
-		# responses are at most two-dimensional (array within array), so simply
-		# join any such values
 		if flatten:
-			for field in app:
-				if isinstance(app[field], list):
-					app[field] = ",".join(app[field])
-				elif isinstance(app[field], dict):
-					app[field] = ", ".join(["%s star: %s" % (key, value) for key,value in app[field].items()])
+			app = self._flatten_app(app)
 
 		if add_ratings:
-			try:
-				ratings = self.get_app_ratings(app_id, countries=[country])
-				app['histogram'] = [value for key, value in ratings.items()]
-			except AppStoreException:
-				# Return some details
-				self._log_error(country, 'Unable to collect ratings for %s' % str(app_id))
-				app['histogram'] = None
+			app['histogram'] = self._get_histogram(app_id, country, use_cache=use_cache and not force)
 
 		# url = f"https://apps.apple.com/{country}/app/id{app_id}"
 		# options = {
@@ -248,30 +304,62 @@ class AppStoreScraper:
 		# app['offersIAP'] = iap
 		# app['developerWebsite'] = developer_website
 
+		self._set_cached_app(cache_key, app)
 		return app
 
-	def get_multiple_app_details(self, app_ids, country="us", lang="", add_ratings=False, sleep=1, force=False):
+	def get_multiple_app_details(self, app_ids, country="us", lang="", add_ratings=False, sleep=None, force=False, use_cache=True):
 		"""
 		Get app details for a list of app IDs
 
-		:param list app_id:  App IDs to retrieve details for
+		Apps are looked up in batches of `LOOKUP_BATCH_SIZE` IDs per request,
+		and `app_ids` is only read one batch at a time. Details are yielded in
+		the order of `app_ids`; IDs for which no app could be found are logged
+		and skipped.
+
+		:param app_ids:  App IDs to retrieve details for; any iterable
 		:param str country:  Two-letter country code for the store to search in.
 		                     Defaults to 'us'.
 		:param str lang: Dummy argument for compatibility. Unused.
-		:param int sleep: Seconds to sleep before request to prevent being
-						  temporary blocked if there are many requests in a
-						  short time. Defaults to 1.
+		:param bool add_ratings:  Add a ratings histogram to each app. Ratings
+		                          are requested concurrently per batch.
+		:param int sleep: Seconds to sleep before each batch request, on top
+						  of the per-host rate limiting. Defaults to None.
 		:param bool force:  by-passes the server side caching by adding a timestamp
-		                    to the request (default is False)
+		                    to the request (default is False). Also by-passes
+		                    the local cache.
+		:param bool use_cache:  Use recently retrieved details from the local
+		                        cache where available (default is True)
 
 		:return generator:  A list (via a generator) of app details
 		"""
-		for app_id in app_ids:
-			try:
-				yield self.get_app_details(app_id, country=country, lang=lang, add_ratings=add_ratings, sleep=sleep, force=force)
-			except AppStoreException as ase:
-				self._log_error(country, str(ase))
-				continue
+		app_ids = iter(app_ids)
+
+		while True:
+			# only read as many IDs as are needed for the next batch
+			batch = [(app_id, self._get_lookup_key(app_id)) for app_id in itertools.islice(app_ids, self.LOOKUP_BATCH_SIZE)]
+			if not batch:
+				break
+
+			cached, uncached = self._split_cached_batch(batch, country, add_ratings, use_cache and not force)
+
+			found = {}
+			if uncached:
+				if sleep is not None:
+					time.sleep(sleep)
+
+				found, failed = self._lookup_apps(list(uncached.values()), country, force)
+				uncached = self._drop_failed_lookups(uncached, failed, country)
+
+			new_apps = self._collect_found_apps(uncached, found, country)
+
+			if add_ratings and new_apps:
+				with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+					histograms = list(executor.map(lambda app: self._get_histogram(app["trackId"], country, use_cache=use_cache and not force), new_apps.values()))
+
+				for app, histogram in zip(new_apps.values(), histograms):
+					app['histogram'] = histogram
+
+			yield from self._finish_batch(batch, cached, new_apps, country, add_ratings)
 
 	def get_store_id_for_country(self, country="us"):
 		"""
@@ -281,70 +369,165 @@ class AppStoreScraper:
 		:param str country:  Two-letter country code for the store to search in.
 		                     Defaults to 'us'.
 		"""
-		country = country.upper()
-
-		if hasattr(AppStoreMarkets, country):
-			return getattr(AppStoreMarkets, country)
-		else:
-			raise AppStoreException("Country code not found for {0}".format(country))
+		try:
+			return _MARKET_BY_CC[country.upper()]
+		except KeyError:
+			raise AppStoreException("Country code not found for {0}".format(country.upper()))
 
-	def get_app_ratings(self, app_id, countries=None, sleep=1):
+	def get_app_ratings(self, app_id, countries=None, sleep=None, use_cache=True):
 		"""
 		Get app ratings for given app ID
 
+		If there are several countries, their ratings are requested
+		concurrently, using up to `max_workers` threads.
+
 		:param app_id:  App ID to retrieve details for. Can be either the
 		                numerical trackID or the textual BundleID.
 		:countries:     List of countries (lowercase, 2 letter code) or single country (e.g. 'de')
 		                to generate the rating for
 		                if left empty, it defaults to mostly european countries (see below)
-		:param int sleep: Seconds to sleep before request to prevent being
-						  temporary blocked if there are many requests in a
-						  short time. Defaults to 1.
+		:param int sleep: Seconds to sleep before each request, on top of the
+						  per-host rate limiting. Defaults to None.
+		:param bool use_cache:  Return recently retrieved ratings for the same
+		                        app and countries from the local cache (default
+		                        is True)
 
 		:return dict:  App ratings, as scraped from the app store.
 		"""
-		dataset = { 1: 0, 2: 0, 3: 0, 4: 0, 5: 0 }
 		if countries is None:
 			countries = COUNTRIES
 		elif isinstance(countries, str): # only a string provided
 			countries = [countries]
 		else:
-			countries = countries
-
-		for country in countries:
-			url = "https://itunes.apple.com/%s/customer-reviews/id%s?displayable-kind=11" % (country, app_id)
-			store_id = self.get_store_id_for_country(country)
-			headers = { 'X-Apple-Store-Front': '%s,12 t:native' % store_id }
-
-			try:
-				if sleep is not None:
-					time.sleep(sleep)
-				result = requests.get(url, headers=headers).text
-			except Exception:
-				try:
-					# handle the retry here.
-					# Take an extra sleep as back off and then retry the URL once.
-					time.sleep(2)
-					result = requests.get(url, headers=headers).text
-				except Exception:
-					raise AppStoreException("Could not parse app store rating response for ID %s" % app_id)
-
-			ratings = self._parse_rating(result)
+			# may be any iterable, which is used more than once below
+			countries = list(countries)
+
+		cache_key = (str(app_id), tuple(countries))
+		if use_cache:
+			cached = self._get_cached(self._ratings_cache, cache_key)
+			if cached is not None:
+				return cached
+
+		if len(countries) == 1:
+			# e.g. from get_app_details, possibly already in a worker thread
+			results = [self._fetch_country_rating(app_id, countries[0], sleep)]
+		else:
+			with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+				results = list(executor.map(lambda country: self._fetch_country_rating(app_id, country, sleep), countries))
 
+		totals = [0] * 5
+		for ratings in results:
 			if ratings is not None:
-				dataset[1] = dataset[1] + ratings[1]
-				dataset[2] = dataset[2] + ratings[2]
-				dataset[3] = dataset[3] + ratings[3]
-				dataset[4] = dataset[4] + ratings[4]
-				dataset[5] = dataset[5] + ratings[5]
+				totals = [total + count for total, count in zip(totals, ratings)]
+
+		dataset = self._ratings_to_dict(totals)
 
         # debug
 		#,print("-----------------------")
 		#,print('%d ratings' % (dataset[1] + dataset[2] + dataset[3] + dataset[4] + dataset[5]))
 		#,print(dataset)
 
+		self._set_cached(self._ratings_cache, cache_key, dataset)
 		return dataset
 	
+	def get_ratings_matrix(self, app_ids, countries=None, sleep=None):
+		"""
+		Get ratings histograms for many apps at once
+
+		Ratings for every combination of app and country are requested
+		concurrently, using up to `max_workers` threads, and summed per app
+		with numpy. Ratings that cannot be collected are logged and counted
+		as zero. Requires numpy.
+
+		:param list app_ids:  App IDs to retrieve ratings for
+		:param countries:  List of countries (lowercase, 2 letter code) or
+		                   single country to sum the ratings over. Defaults to
+		                   the same countries as `get_app_ratings`.
+		:param int sleep: Seconds to sleep before each request, on top of the
+						  per-host rate limiting. Defaults to None.
+
+		:return numpy.ndarray:  Array of shape (len(app_ids), 5), with per
+		                        app the amount of ratings for one through five
+		                        stars
+		"""
+		if countries is None:
+			countries = COUNTRIES
+		elif isinstance(countries, str): # only a string provided
+			countries = [countries]
+		else:
+			countries = list(countries)
+
+		app_ids = list(app_ids)
+		matrix = self._new_ratings_matrix(len(app_ids), len(countries))
+		cells = [(i, j) for i in range(len(app_ids)) for j in range(len(countries))]
+
+		def fetch(cell):
+			app_id, country = app_ids[cell[0]], countries[cell[1]]
+			try:
+				return self._fetch_country_rating(app_id, country, sleep)
+			except AppStoreException:
+				self._log_error(country, 'Unable to collect ratings for %s' % str(app_id))
+				return None
+
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			for (i, j), ratings in zip(cells, executor.map(fetch, cells)):
+				if ratings is not None:
+					matrix[i, j] = ratings[::-1]
+
+		return matrix.sum(axis=1)
+
+	def _new_ratings_matrix(self, num_apps, num_countries):
+		"""
+		Allocate an array for per-app, per-country ratings
+
+		:param int num_apps:  Amount of apps
+		:param int num_countries:  Amount of countries
+
+		:return numpy.ndarray:  Zeroed array of shape (num_apps, num_countries,
+		                        5), with star counts from one star up to five
+		"""
+		if np is None:
+			raise AppStoreException("numpy is required for ratings matrices; install it with 'pip install itunes-app-scraper-dmi[numpy]'")
+
+		return np.zeros((num_apps, num_countries, 5), dtype=np.int64)
+
+	def _fetch_country_rating(self, app_id, country, sleep=None):
+		"""
+		Get the ratings histogram for an app in a single country's store
+
+		:param app_id:  App ID to retrieve ratings for
+		:param str country:  Two-letter country code
+		:param int sleep:  Seconds to sleep before the request
+
+		:return tuple|None:  Ratings from five stars down to one, or None if
+		                     they could not be parsed
+		"""
+		url = "https://itunes.apple.com/%s/customer-reviews/id%s?displayable-kind=11" % (country, app_id)
+		headers = self._get_rating_headers(country)
+
+		if sleep is not None:
+			time.sleep(sleep)
+
+		try:
+			result = self._request_with_retry(url, headers=headers).content
+		except AppStoreException:
+			raise AppStoreException("Could not parse app store rating response for ID %s" % app_id)
+
+		return self._parse_rating(result)
+
+	def _get_rating_headers(self, country):
+		"""
+		Get the request headers for a country's customer reviews pages
+
+		:param str country:  Two-letter country code
+
+		:return dict:  Shared headers; do not modify
+		"""
+		try:
+			return self._rating_headers[country.lower()]
+		except KeyError:
+			raise AppStoreException("Country code not found for {0}".format(country.upper()))
+
 	def get_app_from_collection_category(self, collection: str, category: str, device: str = "iphone", country: str = 'us') -> List[str]:
 		"""
 		Get the app IDs from a collection and category
@@ -361,19 +544,22 @@ class AppStoreScraper:
 
 		url = f"https://apps.apple.com/{country}/charts/{device}/{category_data[0]}/{category_data[1]}?chart={collection}"
 		
-		options = {
-			'url': url,
-		}
+		# only look at the chart itself, not at links elsewhere on the page,
+		# and stop downloading once it has been read
+		content = self._read_until(url, b"</ol>", start_marker=b'id="charts-content-section"')
+		start = content.find(b'id="charts-content-section"')
+		if start < 0:
+			return []
+		end = content.find(b"</ol>", start)
 
-		response = requests.get(**options)
-		tree = html.fromstring(response.content)
-		data = tree.xpath('//*[@id="charts-content-section"]/ol/li/a/@href')
-		appIDs = [ url.split("/id")[-1] for url in data[:100] ]
+		# chart entries may link to the same app more than once, e.g. from
+		# both the icon and the title
+		matches = Regex.APP_ID_HREF.findall(content, start, end if end >= 0 else len(content))
+		appIDs = [ app_id.decode() for app_id in dict.fromkeys(matches) ][:100]
 		return appIDs
 	
 	def get_suggestion_from_query(self, query: str, country: str = 'us') -> List[str]:
-		if hasattr(AppStoreMarkets, country):
-			country = getattr(AppStoreMarkets, country)
+		country = _MARKET_BY_CC.get(country.upper(), country)
 
 		url = "https://search.itunes.apple.com/WebObjects/MZSearchHints.woa/wa/hints?clientApplication=Software&term=" + requests.utils.quote(query)
 
@@ -381,34 +567,468 @@ class AppStoreScraper:
 			'X-Apple-Store-Front': f"{country},29"
 		}
 
-		response = requests.get(url, headers=headers)
+		response = self._request_with_retry(url, headers=headers)
 		response.raise_for_status()
-		tree = html.fromstring(response.content)
-		data = tree.xpath('//string/text()')
-		
+		data = [ unescape(value.decode("utf-8")) for value in Regex.SUGGESTION.findall(response.content) ]
+
 		#remove all links from list
 		data = [x for x in data if not x.startswith("https://")]
 
 		return data[1:]
 
-	def _parse_rating(self, text):
-		matches = Regex.STARS.findall(text)
+	def _read_until(self, url, end_marker, start_marker=None, headers=None, chunk_size=65536):
+		"""
+		Download a page until a marker has been read, and no further
+
+		Useful for large HTML pages of which only a small part is needed.
+
+		:param str url:  URL to request
+		:param bytes end_marker:  Stop once this has been read
+		:param bytes start_marker:  Only look for `end_marker` after this has
+		                            been read
+		:param dict headers:  Request headers
+		:param int chunk_size:  Amount of bytes to read at a time
+
+		:return bytearray:  The page up to and including the chunk with the
+		                    end marker, or the whole page if it was not found
+		"""
+		buffer = bytearray()
+		start = 0 if start_marker is None else -1
+		overlap = max(len(start_marker or b""), len(end_marker))
+
+		with self._request_with_retry(url, headers=headers, stream=True) as response:
+			for chunk in response.iter_content(chunk_size):
+				# only scan the new bytes, plus enough to catch a marker that
+				# is split across chunks
+				scan_from = max(0, len(buffer) - overlap)
+				buffer.extend(chunk)
+
+				if start < 0:
+					start = buffer.find(start_marker, scan_from)
+					if start < 0:
+						continue
+
+				if buffer.find(end_marker, max(start, scan_from)) >= 0:
+					break
+
+		return buffer
+
+	def _request_with_retry(self, url, headers=None, max_retries=5, base=0.5, cap=30, as_json=False, **kwargs):
+		"""
+		Request a URL, retrying with exponential backoff if that fails
+
+		Requests are paced by a rate limiter per host. Connection errors,
+		unparseable responses and throttling (HTTP 429 and 503) are retried
+		after a randomised, exponentially increasing delay ("full jitter"), so
+		that many clients backing off at once do not all retry at the same
+		moment. If the store sends a `Retry-After` header, all requests to
+		that host are held off for that long instead, up to `cap` seconds.
+
+		:param str url:  URL to request
+		:param dict headers:  Request headers
+		:param int max_retries:  Amount of attempts before giving up
+		:param float base:  Base delay in seconds
+		:param float cap:  Maximum delay in seconds
+		:param bool as_json:  Return the parsed JSON body rather than the
+		                      response object
+		:param kwargs:  Passed on to `requests.Session.get`
+
+		:return:  Response, or parsed JSON if `as_json` is True
+		"""
+		rate_limiter = self._get_rate_limiter(url)
+
+		for attempt in range(max_retries):
+			retry_after = None
+			try:
+				rate_limiter.acquire()
+				response = self.session.get(url, headers=headers, **kwargs)
+
+				retry_after = self._hold_off_host(rate_limiter, response.headers, cap)
+
+				if response.status_code not in (429, 503):
+					return orjson.loads(response.content) if as_json else response
+
+				# streamed responses keep their connection until closed
+				response.close()
+			except (requests.RequestException, orjson.JSONDecodeError):
+				pass
+
+			if attempt < max_retries - 1 and retry_after is None:
+				# if the store said when to retry, the rate limiter waits
+				time.sleep(self._backoff_delay(attempt, base, cap))
+
+		raise AppStoreException("Could not retrieve %s after %i attempts" % (url, max_retries))
+
+	def _hold_off_host(self, rate_limiter, headers, cap=30):
+		"""
+		Hold off requests to a host if the store asks for it
+
+		The delay is capped, so that a single large `Retry-After` value does
+		not stall every request to the host indefinitely.
+
+		:param RateLimiter rate_limiter:  Rate limiter for the host
+		:param headers:  Response headers
+		:param float cap:  Maximum delay in seconds
+
+		:return float|None:  Seconds requests are held off for, or None if the
+		                     store did not ask for a delay
+		"""
+		retry_after = self._parse_retry_after(headers.get("Retry-After"))
+		if retry_after is None and headers.get("X-RateLimit-Remaining") == "0":
+			retry_after = rate_limiter.per
+		if retry_after is None:
+			return None
+
+		retry_after = min(retry_after, cap)
+		rate_limiter.block_for(retry_after)
+		return retry_after
+
+	def _get_rate_limiter(self, url):
+		"""
+		Get the rate limiter for the host of a URL
+
+		:param str url:  URL that is to be requested
+
+		:return RateLimiter:  Rate limiter shared by all requests to that host
+		"""
+		host = urlsplit(url).netloc
+		with self._rate_limiters_lock:
+			if host not in self._rate_limiters:
+				self._rate_limiters[host] = RateLimiter(rate=self.rate_limit, per=1.0)
+			return self._rate_limiters[host]
+
+	def _backoff_delay(self, attempt, base=0.5, cap=30):
+		"""
+		Get the delay before the next retry
+
+		:param int attempt:  Number of the failed attempt, starting at 0
+		:param float base:  Base delay in seconds
+		:param float cap:  Maximum delay in seconds
+
+		:return float:  Seconds to wait, between 0 and `base * 2^attempt`
+		"""
+		return random.random() * min(cap, base * (2 ** attempt))
+
+	def _parse_retry_after(self, value):
+		"""
+		Parse a `Retry-After` header value
+
+		:param str value:  Header value, either seconds or an HTTP date
+
+		:return float|None:  Seconds to wait, or None if the value is missing
+		                     or invalid
+		"""
+		if not value:
+			return None
+
+		try:
+			return max(0.0, float(value))
+		except ValueError:
+			pass
+
+		try:
+			return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+		except (TypeError, ValueError):
+			return None
+
+	def _lookup_apps(self, app_ids, country="us", force=False):
+		"""
+		Look up details for several apps at once
+
+		The lookup API accepts a comma-separated list of IDs, so this takes
+		one request for all numerical IDs and one for all bundle IDs. If one
+		of these requests fails, the results of the other are still returned.
+
+		:param list app_ids:  App IDs, numerical trackIDs and/or BundleIDs
+		:param str country:  Two-letter country code for the store to search in.
+		:param bool force:  Add a timestamp to by-pass server side caching
+
+		:return tuple:  Unflattened app details, keyed by both their trackID
+		                and BundleID as returned by `_get_lookup_key`, and a
+		                list of app IDs whose request failed
+		"""
+		apps = {}
+		failed = []
+		for url, url_app_ids in self._get_batch_lookup_urls(app_ids, country, force):
+			try:
+				self._index_lookup_result(self._request_with_retry(url, as_json=True), apps)
+			except AppStoreException:
+				failed.extend(url_app_ids)
+
+		return apps, failed
+
+	def _get_batch_lookup_urls(self, app_ids, country="us", force=False):
+		"""
+		Build lookup API URLs for several apps
+
+		:param list app_ids:  App IDs, numerical trackIDs and/or BundleIDs
+		:param str country:  Two-letter country code for the store to search in.
+		:param bool force:  Add a timestamp to by-pass server side caching
+
+		:return list:  (URL, app IDs) tuples; one URL for all numerical IDs
+		               and one for all bundle IDs, if there are any of that
+		               kind, with the app IDs requested through it
+		"""
+		track_ids = []
+		bundle_ids = []
+		for app_id in app_ids:
+			if isinstance(self._get_lookup_key(app_id), int):
+				track_ids.append(app_id)
+			else:
+				bundle_ids.append(app_id)
+
+		return [(self._get_lookup_url(",".join(str(self._get_lookup_key(app_id)) for app_id in ids), country, force, id_field=id_field), ids) for id_field, ids in (("id", track_ids), ("bundleId", bundle_ids)) if ids]
+
+	def _index_lookup_result(self, result, apps):
+		"""
+		Add the apps in a lookup API response to an index
+
+		:param dict result:  Parsed lookup API response
+		:param dict apps:  Index to add to, keyed by both trackID and BundleID
+		"""
+		for app in result.get("results", []):
+			if app.get("wrapperType") == "software":
+				apps[app["trackId"]] = app
+				apps[app["bundleId"]] = app
+
+	def _split_cached_batch(self, batch, country, add_ratings, use_cache=True):
+		"""
+		Split a batch of app IDs into cached apps and IDs to look up
+
+		:param list batch:  (app ID, lookup key) tuples
+		:param str country:  Two-letter country code
+		:param bool add_ratings:  Whether ratings are requested
+		:param bool use_cache:  Whether cached details may be used
+
+		:return tuple:  Cached app details per lookup key, and the app IDs to
+		                look up per lookup key. Apps listed more than once
+		                are only looked up once.
+		"""
+		cached = {}
+		if use_cache:
+			for app_id, key in batch:
+				app = self._get_cached(self._details_cache, (key, country, add_ratings, True))
+				if app is not None:
+					cached[key] = app
+
+		uncached = {}
+		for app_id, key in batch:
+			if key not in cached and key not in uncached:
+				uncached[key] = app_id
+
+		return cached, uncached
+
+	def _drop_failed_lookups(self, uncached, failed, country):
+		"""
+		Log and leave out app IDs whose lookup request failed
+
+		:param dict uncached:  App IDs that were looked up, per lookup key
+		:param list failed:  App IDs whose lookup request failed
+		:param str country:  Two-letter country code, for logging
+
+		:return dict:  The looked up app IDs that were not in a failed request
+		"""
+		failed_keys = set()
+		for app_id in failed:
+			self._log_error(country, "Could not parse app store response for ID %s" % app_id)
+			failed_keys.add(self._get_lookup_key(app_id))
+
+		return {key: app_id for key, app_id in uncached.items() if key not in failed_keys}
+
+	def _collect_found_apps(self, uncached, found, country):
+		"""
+		Pick the looked up apps out of a lookup index, flattened
+
+		:param dict uncached:  App IDs that were looked up, per lookup key
+		:param dict found:  Index as built by `_index_lookup_result`
+		:param str country:  Two-letter country code, for logging
+
+		:return dict:  Flattened app details per lookup key; IDs for which no
+		               app was found are logged and left out
+		"""
+		new_apps = {}
+		for key, app_id in uncached.items():
+			app = found.get(key)
+			if app is None:
+				self._log_error(country, "No app found with ID %s" % app_id)
+			else:
+				new_apps[key] = self._flatten_app(dict(app))
+
+		return new_apps
+
+	def _finish_batch(self, batch, cached, new_apps, country, add_ratings):
+		"""
+		Cache newly looked up apps and put a batch back in order
+
+		:param list batch:  (app ID, lookup key) tuples, in the requested order
+		:param dict cached:  Cached app details per lookup key
+		:param dict new_apps:  Newly looked up app details per lookup key
+		:param str country:  Two-letter country code
+		:param bool add_ratings:  Whether ratings were requested
+
+		:return list:  App details in the order of `batch`
+		"""
+		for key, app in new_apps.items():
+			self._set_cached_app((key, country, add_ratings, True), app)
+
+		apps = []
+		for app_id, key in batch:
+			if key in cached:
+				apps.append(copy.deepcopy(cached[key]))
+			elif key in new_apps:
+				apps.append(copy.deepcopy(new_apps[key]))
+
+		return apps
+
+	def _get_lookup_key(self, app_id):
+		"""
+		Normalise an app ID as passed by the user
+
+		:param app_id:  App ID, either the numerical trackID or the textual
+		                BundleID.
+
+		:return int|str:  The trackID as an integer, or the BundleID
+		"""
+		try:
+			return int(app_id)
+		except ValueError:
+			return str(app_id)
+
+	def _get_histogram(self, app_id, country="us", use_cache=True):
+		"""
+		Get the ratings histogram for an app in a single store
+
+		Failures are logged rather than raised, so that app details can still
+		be returned without ratings.
+
+		:param app_id:  App ID to retrieve ratings for
+		:param str country:  Two-letter country code
+		:param bool use_cache:  Use recently retrieved ratings from the local
+		                        cache where available
+
+		:return list|None:  Amount of ratings for one through five stars, or
+		                    None if they could not be collected
+		"""
+		try:
+			ratings = self.get_app_ratings(app_id, countries=[country], use_cache=use_cache)
+			return [value for key, value in ratings.items()]
+		except AppStoreException:
+			self._log_error(country, 'Unable to collect ratings for %s' % str(app_id))
+			return None
+
+	def _get_cached(self, cache, key):
+		"""
+		Get a copy of a cached result
+
+		:param TTLCache cache:  Cache to look in
+		:param tuple key:  Cache key
+
+		:return dict|None:  Copy of the cached result, or None if it is not
+		                    cached or has expired
+		"""
+		with self._cache_lock:
+			value = cache.get(key)
+
+		return copy.deepcopy(value) if value is not None else None
+
+	def _set_cached(self, cache, key, value):
+		"""
+		Store a copy of a result in the cache
+
+		A deep copy is stored so that callers modifying the returned result,
+		including nested values such as the histogram, do not modify the
+		cached one.
+
+		:param TTLCache cache:  Cache to store in
+		:param tuple key:  Cache key
+		:param dict value:  Result to cache
+		"""
+		with self._cache_lock:
+			cache[key] = copy.deepcopy(value)
+
+	def _set_cached_app(self, key, app):
+		"""
+		Cache app details, unless their ratings could not be collected
+
+		:param tuple key:  Cache key
+		:param dict app:  App details
+		"""
+		if app.get('histogram', True) is not None:
+			self._set_cached(self._details_cache, key, app)
+
+	def _get_lookup_url(self, app_id, country="us", force=False, id_field=None):
+		"""
+		Build the lookup API URL
+
+		:param app_id:  App ID, either the numerical trackID or the textual
+		                BundleID, or several comma-separated IDs of one kind.
+		:param str country:  Two-letter country code for the store to search in.
+		:param bool force:  Add a timestamp to by-pass server side caching
+		:param str id_field:  Lookup parameter, 'id' or 'bundleId'. Inferred
+		                      from `app_id` if left empty.
+
+		:return str:  Lookup URL
+		"""
+		if id_field is None:
+			app_id = self._get_lookup_key(app_id)
+			id_field = "id" if isinstance(app_id, int) else "bundleId"
+
+		if force:
+			# this will by-pass the serverside caching; the counter keeps
+			# URLs unique even within the same nanosecond
+			timestamp = "%d-%d" % (time.time_ns(), next(self._cache_buster_seq))
+			return "https://itunes.apple.com/lookup?%s=%s&country=%s&entity=software&timestamp=%s" % (id_field, app_id, country, timestamp)
+		else:
+			return "https://itunes.apple.com/lookup?%s=%s&country=%s&entity=software" % (id_field, app_id, country)
+
+	def _flatten_app(self, app):
+		"""
+		'Flatten' an app response
+
+		Responses are at most two-dimensional (array within array), so simply
+		join any such values.
+
+		:param dict app:  App details as returned by the lookup API
+
+		:return dict:  The same app details, with only scalar values
+		"""
+		for field in app:
+			if isinstance(app[field], list):
+				app[field] = ",".join(app[field])
+			elif isinstance(app[field], dict):
+				app[field] = ", ".join(["%s star: %s" % (key, value) for key,value in app[field].items()])
+
+		return app
+
+	def _parse_rating(self, content):
+		"""
+		Parse the ratings histogram from a customer reviews page
+
+		:param bytes content:  Raw response body, or any other bytes-like
+		                       object such as a memoryview; it is parsed
+		                       without decoding it
+
+		:return tuple|None:  Ratings from five stars down to one, or None if
+		                     the page does not contain exactly five totals
+		"""
+		matches = Regex.STARS.findall(content)
 
 		if len(matches) != 5:
 			# raise AppStoreException("Cant get stars - expected 5 - but got %d" % len(matches))
 			return None
 
-		ratings = {}
-		star = 5
+		# totals are listed from five stars down to one
+		return tuple(int(value) for value in matches)
 
-		for match in matches:
-			value = match
-			value = value.replace("<span class=\"total\">", "")
-			value = value.replace("</span>", "")
-			ratings[star] = int(value)
-			star = star - 1
+	def _ratings_to_dict(self, ratings):
+		"""
+		Convert parsed ratings to a dictionary
+
+		:param ratings:  Ratings from five stars down to one
 
-		return ratings
+		:return dict:  Ratings per star, from one star up to five
+		"""
+		return {star: ratings[5 - star] for star in range(1, 6)}
 
 	def _log_error(self, app_store_country, message):
 		"""
@@ -417,12 +1037,18 @@ class AppStoreScraper:
 		:param str app_store_country: the country for the app store
 		:param str message: the error message to log
 		"""
+		errortime = datetime.now().strftime('%Y%m%d_%H:%M:%S - ')
+
 		log_dir = 'log/'
-		if not os.path.isdir(log_dir):
-			os.mkdir(log_dir)
+		app_log = os.path.abspath(os.path.join(log_dir, "{0}_log.txt".format(app_store_country)))
 
-		app_log = os.path.join(log_dir, "{0}_log.txt".format(app_store_country))
-		errortime = datetime.now().strftime('%Y%m%d_%H:%M:%S - ')
-		fh = open(app_log, "a")
-		fh.write("%s %s \n" % (errortime,message))
-		fh.close()
+		with _log_lock:
+			fh = _log_handles.get(app_log)
+			if fh is None:
+				os.makedirs(log_dir, exist_ok=True)
+
+				# line-buffered, so every message is on disk straight away
+				fh = open(app_log, "a", buffering=1)
+				_log_handles[app_log] = fh
+
+			fh.write("%s %s \n" % (errortime,message))
@@ -1,7 +1,10 @@
 """
 App Store Scraper utility classes
 """
+import asyncio
 import json
+import threading
+import time
 
 class AppStoreUtils:
 	"""
@@ -12,14 +15,82 @@ class AppStoreUtils:
 		"""
 		Get the members and their names from the function
 
+		Only the class's own members are returned; none of the classes this
+		is used for inherit any.
+
 		:param object clazz_name: the class object be called. 
 		:returns object method_names: a JSON representation of the names.
 		"""
-		methods  = {}
-		for collection in dir(clazz_name):
-			if not collection.startswith('__'):
-				methods[str(collection)] = getattr(clazz_name, str(collection))
-		return methods
+		if not isinstance(clazz_name, type):
+			# an instance was passed; its members are on the class
+			clazz_name = type(clazz_name)
+
+		return {key: value for key, value in vars(clazz_name).items() if not key.startswith('_')}
+
+class RateLimiter:
+	"""
+	Token bucket rate limiter
+
+	Allows bursts of up to `rate` requests, refilling at `rate` requests per
+	`per` seconds. Safe to share between threads; `acquire_async` can be used
+	from coroutines.
+	"""
+	def __init__(self, rate=10, per=1.0):
+		"""
+		:param int rate:  Amount of requests allowed per period
+		:param float per:  Length of the period in seconds
+		"""
+		self.rate = rate
+		self.per = per
+		self._tokens = float(rate)
+		self._updated = time.monotonic()
+		self._blocked_until = 0.0
+		self._lock = threading.Lock()
+
+	def acquire(self):
+		"""
+		Wait until a request may be made
+		"""
+		wait = self._reserve()
+		while wait > 0:
+			time.sleep(wait)
+			wait = self._reserve()
+
+	async def acquire_async(self):
+		"""
+		Wait until a request may be made, without blocking the event loop
+		"""
+		wait = self._reserve()
+		while wait > 0:
+			await asyncio.sleep(wait)
+			wait = self._reserve()
+
+	def _reserve(self):
+		"""
+		Take a token if one is available
+
+		:return float:  0 if a token was taken, otherwise the seconds to wait
+		                before trying again
+		"""
+		with self._lock:
+			now = time.monotonic()
+			self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+			self._updated = now
+
+			if now >= self._blocked_until and self._tokens >= 1:
+				self._tokens -= 1
+				return 0
+
+			return max(self._blocked_until - now, (1 - self._tokens) * self.per / self.rate)
+
+	def block_for(self, seconds):
+		"""
+		Hold off all requests for a while, e.g. when the server asks for it
+
+		:param float seconds:  Seconds from now before the next request
+		"""
+		with self._lock:
+			self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
 
 class AppStoreCollections:
 	"""
@@ -249,6 +320,14 @@ class AppStoreMarkets:
 	YE = 143571
 
 
+# store IDs per upper-case country code, so lookups don't need reflection
+_MARKET_BY_CC = AppStoreUtils.get_entries(AppStoreMarkets)
+
+# storefront header values for the customer reviews pages, per lower-case
+# country code
+COUNTRY_STOREFRONT_HEADERS = {cc.lower(): "%s,12 t:native" % store_id for cc, store_id in _MARKET_BY_CC.items()}
+
+
 class AppStoreException(Exception):
 	"""
 	Thrown when an error occurs in the App Store scraper
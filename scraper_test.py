@@ -1,10 +1,99 @@
 from itunes_app_scraper.scraper import AppStoreScraper
 from itunes_app_scraper.util import AppStoreException, AppStoreCollections, AppStoreCategories, AppStoreUtils
 
+from urllib.parse import urlsplit, parse_qs
 import json
+import orjson
 import pytest
+import requests
 import os
 
+
+class FakeResponse:
+    """
+    Stand-in for requests.Response, for tests that do not hit the store
+    """
+    def __init__(self, content=b"", status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for offset in range(0, len(self.content), chunk_size):
+            yield self.content[offset:offset + chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def rating_page(*totals):
+    return b"".join(b'<span class="total">%d</span>' % total for total in totals)
+
+
+def lookup_body(url, apps):
+    """
+    Build a lookup API response for the IDs requested in a URL
+    """
+    query = parse_qs(urlsplit(url).query)
+    results = []
+    for app_id in query.get("id", [""])[0].split(","):
+        if app_id and int(app_id) in apps:
+            results.append(dict(apps[int(app_id)]))
+    for bundle_id in query.get("bundleId", [""])[0].split(","):
+        results.extend(dict(app) for app in apps.values() if app["bundleId"] == bundle_id)
+    return orjson.dumps({"resultCount": len(results), "results": results})
+
+
+def mock_store(scraper, apps=None, ratings=None):
+    """
+    Route the scraper's requests to canned lookup and rating responses
+
+    :param dict apps:  App details per trackId
+    :param dict ratings:  Star totals (five down to one) per country, or an
+                          exception to raise for that country
+    :return list:  Requested URLs, appended to as requests are made
+    """
+    apps = apps or {}
+    ratings = ratings or {}
+    requested = []
+
+    def get(url, headers=None, **kwargs):
+        requested.append(url)
+        parts = urlsplit(url)
+        if parts.path == "/lookup":
+            return FakeResponse(lookup_body(url, apps))
+
+        country = parts.path.split("/")[1]
+        totals = ratings.get(country, (0, 0, 0, 0, 0))
+        if isinstance(totals, Exception):
+            raise totals
+        return FakeResponse(rating_page(*totals))
+
+    scraper.session.get = get
+    scraper._backoff_delay = lambda *args, **kwargs: 0
+    return requested
+
+
+def lookup_ids(url):
+    query = parse_qs(urlsplit(url).query)
+    return (query.get("id") or query["bundleId"])[0]
+
+
+APPS = {
+    1: {"wrapperType": "software", "trackId": 1, "bundleId": "com.example.one", "trackName": "One", "genres": ["Games", "Puzzle"]},
+    2: {"wrapperType": "software", "trackId": 2, "bundleId": "com.example.two", "trackName": "Two", "genres": ["Books"]},
+}
+
 def test_term_no_exception():
     scraper = AppStoreScraper()
     results = scraper.get_app_ids_for_query("mindful", country="gb", lang="en")
@@ -48,3 +137,251 @@ def test_country_code_does_not_exist():
     scraper = AppStoreScraper()
     with pytest.raises(AppStoreException, match="Country code not found for XZ"):
         scraper.get_store_id_for_country('xz')
+
+def test_backoff_delay_is_capped():
+    scraper = AppStoreScraper()
+    for attempt in range(10):
+        assert 0 <= scraper._backoff_delay(attempt, base=0.5, cap=4) <= min(4, 0.5 * 2 ** attempt)
+
+def test_retry_after_in_seconds():
+    scraper = AppStoreScraper()
+    assert scraper._parse_retry_after("3") == 3.0
+    assert scraper._parse_retry_after(None) is None
+    assert scraper._parse_retry_after("soon") is None
+
+def test_parse_rating_histogram():
+    scraper = AppStoreScraper()
+    page = b"".join(b'<span class="total">%d</span>' % total for total in (50, 40, 30, 20, 10))
+    assert scraper._parse_rating(page) == (50, 40, 30, 20, 10)
+    assert scraper._ratings_to_dict((50, 40, 30, 20, 10)) == {1: 10, 2: 20, 3: 30, 4: 40, 5: 50}
+    assert scraper._parse_rating(memoryview(page)) == (50, 40, 30, 20, 10)
+    assert scraper._parse_rating(b'<span class="total">1</span>') is None
+
+def test_force_and_no_cache_refetch_ratings():
+    scraper = AppStoreScraper()
+    requested = mock_store(scraper, apps=APPS, ratings={"us": (5, 4, 3, 2, 1)})
+    assert scraper.get_app_details(1)["histogram"] == [1, 2, 3, 4, 5]
+
+    mock_store(scraper, apps=APPS, ratings={"us": (50, 40, 30, 20, 10)})
+    assert scraper.get_app_details(1)["histogram"] == [1, 2, 3, 4, 5]
+    assert scraper.get_app_details(1, force=True)["histogram"] == [10, 20, 30, 40, 50]
+
+    requested = mock_store(scraper, apps=APPS, ratings={"us": (500, 400, 300, 200, 100)})
+    assert scraper.get_app_details(1, use_cache=False)["histogram"] == [100, 200, 300, 400, 500]
+    assert any("customer-reviews" in url for url in requested)
+
+    requested = mock_store(scraper, apps=APPS, ratings={"us": (7, 7, 7, 7, 7)})
+    apps = list(scraper.get_multiple_app_details([1], add_ratings=True, force=True))
+    assert apps[0]["histogram"] == [7, 7, 7, 7, 7]
+
+def test_ratings_for_generator_of_countries_are_fetched_and_cached():
+    scraper = AppStoreScraper()
+    mock_store(scraper, ratings={"de": (5, 4, 3, 2, 1), "nl": (1, 1, 1, 1, 1)})
+    expected = {1: 2, 2: 3, 3: 4, 4: 5, 5: 6}
+    assert scraper.get_app_ratings(1, countries=(cc for cc in ["de", "nl"])) == expected
+
+    requested = mock_store(scraper)
+    assert scraper.get_app_ratings(1, countries=["de", "nl"]) == expected
+    assert requested == []
+
+def test_cached_results_are_not_modified_through_returned_copies():
+    scraper = AppStoreScraper()
+    mock_store(scraper, apps=APPS, ratings={"de": (5, 4, 3, 2, 1)})
+    scraper.get_app_details(1, country="de")["histogram"].append(99)
+    assert scraper.get_app_details(1, country="de")["histogram"] == [1, 2, 3, 4, 5]
+
+    scraper.get_app_details(1, add_ratings=False, flatten=False)["genres"].append("Action")
+    assert scraper.get_app_details(1, add_ratings=False, flatten=False)["genres"] == ["Games", "Puzzle"]
+
+    apps = list(scraper.get_multiple_app_details([2, 2], country="de", add_ratings=True))
+    apps[0]["histogram"].append(99)
+    assert apps[1]["histogram"] == [1, 2, 3, 4, 5]
+    assert list(scraper.get_multiple_app_details([2], country="de", add_ratings=True))[0]["histogram"] == [1, 2, 3, 4, 5]
+
+def test_scraper_can_be_garbage_collected(monkeypatch, tmp_path):
+    import gc
+    import weakref
+    monkeypatch.chdir(tmp_path)
+    scraper = AppStoreScraper()
+    scraper._log_error("gb", "test")
+    ref = weakref.ref(scraper)
+    del scraper
+    gc.collect()
+    assert ref() is None
+
+def test_close_closes_logs_and_session(monkeypatch, tmp_path):
+    from itunes_app_scraper import scraper as scraper_module
+    monkeypatch.chdir(tmp_path)
+    scraper = AppStoreScraper()
+    closed = []
+    session_close = scraper.session.close
+    monkeypatch.setattr(scraper.session, "close", lambda: closed.append(True) or session_close())
+    scraper._log_error("gb", "before close")
+    scraper.close()
+    assert closed == [True]
+    assert scraper_module._log_handles == {}
+    scraper._log_error("gb", "after close")
+    fh = open('log/gb_log.txt')
+    assert "after close" in fh.read()
+    fh.close()
+    scraper.close()
+
+def test_single_country_ratings_skip_thread_pool(monkeypatch):
+    from itunes_app_scraper import scraper as scraper_module
+    scraper = AppStoreScraper()
+    mock_store(scraper, ratings={"de": (5, 4, 3, 2, 1)})
+    monkeypatch.setattr(scraper_module, "ThreadPoolExecutor", None)
+    assert scraper.get_app_ratings(1, countries="de") == {1: 1, 2: 2, 3: 3, 4: 4, 5: 5}
+
+def test_single_country_ratings_accept_set_and_generator():
+    scraper = AppStoreScraper()
+    mock_store(scraper, ratings={"de": (5, 4, 3, 2, 1)})
+    expected = {1: 1, 2: 2, 3: 3, 4: 4, 5: 5}
+    assert scraper.get_app_ratings(1, countries={"de"}, use_cache=False) == expected
+    assert scraper.get_app_ratings(1, countries=(cc for cc in ["de"]), use_cache=False) == expected
+
+def test_multiple_details_keep_input_order():
+    scraper = AppStoreScraper()
+    requested = mock_store(scraper, apps=APPS)
+    apps = list(scraper.get_multiple_app_details([2, "1"]))
+    assert [app["trackName"] for app in apps] == ["Two", "One"]
+    assert apps[0]["genres"] == "Books"
+    assert len(requested) == 1
+
+def test_multiple_details_mix_track_and_bundle_ids():
+    scraper = AppStoreScraper()
+    requested = mock_store(scraper, apps=APPS)
+    apps = list(scraper.get_multiple_app_details(["com.example.two", 1]))
+    assert [app["trackName"] for app in apps] == ["Two", "One"]
+    assert sorted(lookup_ids(url) for url in requested) == ["1", "com.example.two"]
+
+def test_multiple_details_log_and_skip_missing_id():
+    scraper = AppStoreScraper()
+    mock_store(scraper, apps=APPS)
+    logged = []
+    scraper._log_error = lambda country, message: logged.append(message)
+    apps = list(scraper.get_multiple_app_details([1, 872, 2]))
+    assert [app["trackId"] for app in apps] == [1, 2]
+    assert logged == ["No app found with ID 872"]
+
+def test_multiple_details_only_look_up_uncached_ids():
+    scraper = AppStoreScraper()
+    mock_store(scraper, apps=APPS)
+    list(scraper.get_multiple_app_details([1]))
+    requested = mock_store(scraper, apps=APPS)
+    apps = list(scraper.get_multiple_app_details([1, 2]))
+    assert [app["trackId"] for app in apps] == [1, 2]
+    assert [lookup_ids(url) for url in requested] == ["2"]
+
+def test_multiple_details_look_up_duplicate_ids_once():
+    scraper = AppStoreScraper()
+    requested = mock_store(scraper, apps=APPS)
+    apps = list(scraper.get_multiple_app_details([1, 2, 1]))
+    assert [app["trackId"] for app in apps] == [1, 2, 1]
+    assert [lookup_ids(url) for url in requested] == ["1,2"]
+
+def test_ratings_matrix_sums_countries_and_zeroes_failures():
+    pytest.importorskip("numpy")
+    scraper = AppStoreScraper()
+    mock_store(scraper, ratings={"de": (5, 4, 3, 2, 1), "nl": requests.ConnectionError()})
+    logged = []
+    scraper._log_error = lambda country, message: logged.append((country, message))
+    matrix = scraper.get_ratings_matrix([1, 2, 3], countries=["de", "nl", "us"])
+    assert matrix.shape == (3, 5)
+    assert matrix.tolist() == [[1, 2, 3, 4, 5]] * 3
+    assert sorted(logged) == [("nl", "Unable to collect ratings for %i" % app_id) for app_id in (1, 2, 3)]
+
+def test_chart_ids_come_from_chart_section_only_once_each():
+    scraper = AppStoreScraper()
+    page = (b'<a href="https://apps.apple.com/us/app/elsewhere/id999">Elsewhere</a>'
+            b'<section id="charts-content-section"><ol>'
+            b'<li><a href="https://apps.apple.com/us/app/first/id111"><img src="icon.png"></a>'
+            b'<a href="https://apps.apple.com/us/app/first/id111">First</a></li>'
+            b'<li><a href="https://apps.apple.com/us/app/second/id222">Second</a></li>'
+            b'</ol></section>'
+            b'<a href="https://apps.apple.com/us/app/after/id333">After</a>')
+    scraper.session.get = lambda url, **kwargs: FakeResponse(page)
+    assert scraper.get_app_from_collection_category("top-free", "APPLE_BOOKS") == ["111", "222"]
+
+def test_suggestions_are_unescaped_and_exclude_links():
+    scraper = AppStoreScraper()
+    plist = (b'<?xml version="1.0" encoding="UTF-8"?><plist version="1.0"><dict>'
+             b'<key>title</key><string>Suggestions</string><key>hints</key><array>'
+             b'<dict><key>term</key><string>maps &amp; navigation</string>'
+             b'<key>url</key><string>https://search.itunes.apple.com/hint?term=maps</string></dict>'
+             b'<dict><key>term</key><string>caf&#233; finder</string></dict>'
+             b'</array></dict></plist>')
+    scraper.session.get = lambda url, **kwargs: FakeResponse(plist)
+    assert scraper.get_suggestion_from_query("maps") == ["maps & navigation", "caf\u00e9 finder"]
+
+def test_multiple_details_read_app_ids_one_batch_at_a_time():
+    scraper = AppStoreScraper()
+    scraper.LOOKUP_BATCH_SIZE = 2
+    mock_store(scraper, apps=APPS)
+    consumed = []
+
+    def app_ids():
+        for app_id in [1, 2, 1, 2]:
+            consumed.append(app_id)
+            yield app_id
+
+    apps = scraper.get_multiple_app_details(app_ids())
+    assert next(apps)["trackId"] == 1
+    assert consumed == [1, 2]
+
+def test_multiple_details_keep_results_of_successful_lookup():
+    scraper = AppStoreScraper()
+    mock_store(scraper, apps=APPS)
+    store_get = scraper.session.get
+
+    def get(url, **kwargs):
+        if "bundleId=" in url:
+            raise requests.ConnectionError()
+        return store_get(url, **kwargs)
+
+    scraper.session.get = get
+    logged = []
+    scraper._log_error = lambda country, message: logged.append(message)
+    apps = list(scraper.get_multiple_app_details([1, "com.example.two"]))
+    assert [app["trackId"] for app in apps] == [1]
+    assert logged == ["Could not parse app store response for ID com.example.two"]
+
+def test_read_until_finds_markers_split_across_chunks():
+    scraper = AppStoreScraper()
+    start_marker = b'id="charts-content-section"'
+    page = b"<ol>early</ol> <ol " + start_marker + b"><li>app</li></ol>" + b"footer" * 100
+    response = FakeResponse(page)
+    scraper.session.get = lambda url, **kwargs: response
+
+    # with 4-byte chunks, both markers are split across chunks
+    result = bytes(scraper._read_until("https://example.com", b"</ol>", start_marker=start_marker, chunk_size=4))
+
+    # the </ol> before the start marker does not end the read; the one after does
+    end = page.index(b"</ol>", page.index(start_marker)) + len(b"</ol>")
+    assert page.startswith(result)
+    assert end <= len(result) < end + 4
+    assert response.closed
+
+def test_read_until_reads_whole_page_without_end_marker():
+    scraper = AppStoreScraper()
+    page = b"no markers here" * 10
+    scraper.session.get = lambda url, **kwargs: FakeResponse(page)
+    assert bytes(scraper._read_until("https://example.com", b"</ol>", chunk_size=7)) == page
+
+def test_throttled_response_is_closed_before_retry():
+    scraper = AppStoreScraper()
+    scraper._backoff_delay = lambda *args, **kwargs: 0
+    responses = [FakeResponse(status_code=429), FakeResponse(b"ok")]
+    throttled = responses[0]
+    scraper.session.get = lambda url, **kwargs: responses.pop(0)
+    assert scraper._request_with_retry("https://example.com", stream=True).content == b"ok"
+    assert throttled.closed
+
+def test_retry_after_is_capped():
+    import time
+    scraper = AppStoreScraper()
+    responses = [FakeResponse(status_code=429, headers={"Retry-After": "3600"}), FakeResponse(b"ok")]
+    scraper.session.get = lambda url, **kwargs: responses.pop(0)
+    start = time.monotonic()
+    assert scraper._request_with_retry("https://example.com", cap=0.1).content == b"ok"
+    assert time.monotonic() - start < 1
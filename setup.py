@@ -18,6 +18,10 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
-    install_requires = ['requests'],
+    python_requires='>=3.7',
+    install_requires = ['requests', 'orjson', 'cachetools'],
+    extras_require = {
+        'async': ['aiohttp'],
+        'numpy': ['numpy'],
+    },
 )
@@ -1,8 +1,9 @@
-from itunes_app_scraper.util import AppStoreException, AppStoreCollections, AppStoreCategories, AppStoreUtils
+from itunes_app_scraper.util import AppStoreException, AppStoreCollections, AppStoreCategories, AppStoreUtils, RateLimiter, COUNTRY_STOREFRONT_HEADERS
 
 import json
 import pytest
 import os
+import time
 
 def test_category_exists():
     category = AppStoreCategories()
@@ -25,4 +26,25 @@ def test_collection_does_not_exist():
 def test_app_utils():
     utils = AppStoreUtils()
     json_object = json.loads(utils.get_entries(AppStoreCollections()))
-    assert "names" in json_object
\ No newline at end of file
+    assert "names" in json_object
+
+
+def test_storefront_header_for_country():
+    assert COUNTRY_STOREFRONT_HEADERS["gb"] == "143444,12 t:native"
+
+def test_rate_limiter_waits_once_burst_is_used():
+    limiter = RateLimiter(rate=5, per=0.5)
+    start = time.monotonic()
+    for i in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.05
+
+    limiter.acquire()
+    assert 0.08 <= time.monotonic() - start < 0.3
+
+def test_rate_limiter_block_for_delays_next_acquire():
+    limiter = RateLimiter(rate=5, per=1.0)
+    limiter.block_for(0.2)
+    start = time.monotonic()
+    limiter.acquire()
+    assert 0.18 <= time.monotonic() - start < 0.5